@@ -4,16 +4,27 @@
 """Core functionality."""
 
 import os
+import re
 import sys
+import copy
+import time
+import types
+import logging
 import argparse
+import tempfile
 import importlib
 from pkg_resources import require, resource_filename, resource_listdir
 
 import cclib
+import numpy as np
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2.exceptions import SecurityError
+from jinja2.sandbox import SandboxedEnvironment
 
 __version__ = require(__name__)[0].version
 
+logger = logging.getLogger(__name__)
+
 table = cclib.parser.utils.PeriodicTable()
 
 REPOSITORY = {
@@ -21,6 +32,182 @@ REPOSITORY = {
     for name in resource_listdir(__name__, "repo")
 }
 
+# Patterns used by read_last_geometry. Each entry maps a coordinate block
+# header to a regex matching one atom line inside it, with named groups for
+# the element ("symbol" or "atomno") and the Cartesian coordinates in
+# angstroms.
+_TAIL_COORDINATE_PATTERNS = [
+    # ORCA
+    (
+        re.compile(rb"CARTESIAN COORDINATES \(ANGSTROEM\)\s*\n-+\s*\n"),
+        re.compile(
+            rb"[ \t]*(?P<symbol>[A-Za-z]{1,3})[ \t]+(?P<x>\S+)[ \t]+(?P<y>\S+)"
+            rb"[ \t]+(?P<z>\S+)[ \t]*\r?\n"
+        ),
+    ),
+    # Gaussian
+    (
+        re.compile(rb"(?:Standard|Input) orientation:\s*\n(?:.*\n){4}"),
+        re.compile(
+            rb"[ \t]*\d+[ \t]+(?P<atomno>\d+)[ \t]+-?\d+[ \t]+(?P<x>\S+)"
+            rb"[ \t]+(?P<y>\S+)[ \t]+(?P<z>\S+)[ \t]*\r?\n"
+        ),
+    ),
+]
+_TAIL_OVERLAP = 4096
+_TAIL_CHARGE_PATTERNS = [
+    # ORCA
+    re.compile(rb"Total Charge\s+Charge\s+\.+\s+(?P<charge>-?\d+)"),
+    # Gaussian
+    re.compile(rb"Charge\s+=\s+(?P<charge>-?\d+)\s+Multiplicity"),
+]
+_TAIL_MULT_PATTERNS = [
+    # ORCA
+    re.compile(rb"Multiplicity\s+Mult\s+\.+\s+(?P<mult>\d+)"),
+    # Gaussian
+    re.compile(rb"Charge\s+=\s+-?\d+\s+Multiplicity\s+=\s+(?P<mult>\d+)"),
+]
+
+
+def _last_match(patterns, buffer):
+    """Return the match closest to the end of buffer among all patterns."""
+    last = None
+    for pattern in patterns:
+        for match in pattern.finditer(buffer):
+            if last is None or match.start() > last.start():
+                last = match
+    return last
+
+
+def _last_header(buffer):
+    """Return (match, line_pattern) for the last coordinate header in buffer."""
+    last_header, last_line_pattern = None, None
+    for header_pattern, line_pattern in _TAIL_COORDINATE_PATTERNS:
+        for header in header_pattern.finditer(buffer):
+            if last_header is None or header.start() > last_header.start():
+                last_header, last_line_pattern = header, line_pattern
+    return last_header, last_line_pattern
+
+
+def _parse_coordinate_block(stream, position, line_pattern, chunk_size):
+    """Return (atomnos, coords) for the block starting at position, or None."""
+    stream.seek(position)
+    buffer = stream.read(chunk_size)
+    at_end = len(buffer) < chunk_size
+
+    atomnos, coords = [], []
+    index = 0
+    while True:
+        line = line_pattern.match(buffer, index)
+        if line is None:
+            # Blocks larger than a chunk are read forward as needed
+            if at_end or b"\n" in buffer[index:]:
+                break
+            more = stream.read(chunk_size)
+            at_end = len(more) < chunk_size
+            buffer, index = buffer[index:] + more, 0
+            continue
+        index = line.end()
+
+        groups = line.groupdict()
+        try:
+            if groups.get("symbol") is not None:
+                symbol = groups["symbol"].decode()
+                atomnos.append(table.number[symbol.capitalize()])
+            else:
+                atomnos.append(int(groups["atomno"]))
+            coords.append([float(groups[axis]) for axis in "xyz"])
+        except (KeyError, ValueError):
+            return None
+    if not atomnos:
+        return None
+
+    return np.array(atomnos), np.array([coords])
+
+
+def read_last_geometry(path, chunk_size=1 << 20):
+    """
+    Read the last geometry, charge and multiplicity of a QM output file.
+
+    The file is read backwards in chunks of ``chunk_size`` bytes until the
+    last coordinate block, charge and multiplicity are all found, so that
+    only the tail of large logs needs to be touched. Each chunk is searched
+    only once. ORCA and Gaussian outputs are currently understood.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output file.
+    chunk_size : int, optional
+        Number of bytes read at a time, starting from the end of the file.
+
+    Returns
+    -------
+    cclib.parser.ccData or None
+        An object with ``atomcoords`` (a single frame), ``atomnos``,
+        ``charge`` and ``mult``, or None if the file could not be understood,
+        in which case a full parse (e.g. ``cclib.ccopen(path).parse()``)
+        should be used instead.
+
+    Examples
+    --------
+    >>> data = read_last_geometry("data/benzene.out")
+    >>> data.atomcoords[-1][0]
+    array([ 1.745893,  1.795753, -1.059753])
+    >>> data.charge, data.mult
+    (0, 1)
+
+    """
+    with open(path, "rb") as stream:
+        stream.seek(0, os.SEEK_END)
+        position = stream.tell()
+        carry = b""
+        geometry = charge = mult = None
+
+        while position > 0:
+            offset = max(position - chunk_size, 0)
+            stream.seek(offset)
+            buffer = stream.read(position - offset) + carry
+            position = offset
+
+            # Skip the (possibly partial) first line unless this is the start
+            # of the file, so that nothing is matched across chunk boundaries.
+            # It is searched again with the next chunk, as part of carry.
+            start = buffer.find(b"\n") + 1 if position > 0 else 0
+            searchable = memoryview(buffer)[start:]
+
+            if geometry is None:
+                header, line_pattern = _last_header(searchable)
+                if header is not None:
+                    geometry = _parse_coordinate_block(
+                        stream, offset + start + header.end(), line_pattern, chunk_size
+                    )
+                    if geometry is None:
+                        return None
+            if charge is None:
+                charge = _last_match(_TAIL_CHARGE_PATTERNS, searchable)
+            if mult is None:
+                mult = _last_match(_TAIL_MULT_PATTERNS, searchable)
+
+            if geometry is not None and charge is not None and mult is not None:
+                break
+
+            # Only a small overlap is needed to match what spans chunks
+            carry = buffer[:_TAIL_OVERLAP]
+
+    if geometry is None or charge is None or mult is None:
+        return None
+
+    atomnos, atomcoords = geometry
+    return cclib.parser.data.ccData(
+        {
+            "atomcoords": atomcoords,
+            "atomnos": atomnos,
+            "charge": int(charge.group("charge")),
+            "mult": int(mult.group("mult")),
+        }
+    )
+
 
 class Atoms:
     """
@@ -65,6 +252,124 @@ class Atoms:
         """Wrap `Atoms.value` into `Atoms._data.value`."""
         return getattr(self._data, value)
 
+    def _with_atomcoords(self, atomcoords):
+        """Return a copy with the given frames, keeping all other data."""
+        data = copy.copy(self._data)
+        data.atomcoords = np.asarray(atomcoords)
+
+        atoms = Atoms(data)
+        atoms.name = self.name
+        atoms.charge = self.charge
+        atoms.mult = self.mult
+        return atoms
+
+    def _weights(self, weights):
+        """Return normalized per-atom weights (uniform if weights is None)."""
+        if weights is None:
+            weights = np.ones(len(self.atomnos))
+        weights = np.asarray(weights, dtype=float)
+        return weights / weights.sum()
+
+    def frames(self):
+        """
+        Return a list with one Atoms object per frame (geometry).
+
+        This allows templates to generate one input per frame, e.g., after
+        calling ``scan``.
+
+        """
+        return [self._with_atomcoords(coords[np.newaxis]) for coords in self.atomcoords]
+
+    def centered(self, weights=None):
+        """
+        Return a copy with every frame centered at the origin.
+
+        Parameters
+        ----------
+        weights : array-like, optional
+            Per-atom weights (e.g., ``molecule.atommasses`` for the center of
+            mass). The geometric center is used by default.
+
+        """
+        atomcoords = np.asarray(self.atomcoords, dtype=float)
+        center = np.einsum("n,fni->fi", self._weights(weights), atomcoords)
+        return self._with_atomcoords(atomcoords - center[:, np.newaxis, :])
+
+    def aligned(self, weights=None):
+        """
+        Return a copy with every frame centered and aligned to principal axes.
+
+        Axes are sorted by increasing principal moment, so that the first one
+        is the axis with the smallest moment, and always form a right-handed
+        system.
+
+        Parameters
+        ----------
+        weights : array-like, optional
+            Per-atom weights (e.g., ``molecule.atommasses`` for the standard
+            orientation). Uniform weights are used by default.
+
+        """
+        weights = self._weights(weights)
+        atomcoords = np.asarray(self.centered(weights).atomcoords)
+
+        second_moments = np.einsum("n,fni,fnj->fij", weights, atomcoords, atomcoords)
+        inertia = (
+            np.trace(second_moments, axis1=1, axis2=2)[:, np.newaxis, np.newaxis]
+            * np.eye(3)
+            - second_moments
+        )
+        _, axes = np.linalg.eigh(inertia)
+        axes[..., 2] *= np.sign(np.linalg.det(axes))[:, np.newaxis]
+
+        return self._with_atomcoords(atomcoords @ axes)
+
+    def displaced(self, displacement):
+        """
+        Return a copy with the same displacement added to every frame.
+
+        Parameters
+        ----------
+        displacement : array-like
+            Either a single vector of shape (3,) applied to all atoms (a rigid
+            translation) or per-atom displacements of shape (natoms, 3).
+
+        """
+        atomcoords = np.asarray(self.atomcoords, dtype=float)
+        return self._with_atomcoords(atomcoords + np.asarray(displacement, dtype=float))
+
+    def scan(self, modes, steps):
+        """
+        Return displaced geometries along one or more modes, as many frames.
+
+        Displacements are applied to the last geometry. With many modes, one
+        frame is generated for every combination of steps (a grid).
+
+        Parameters
+        ----------
+        modes : array-like
+            A single mode of shape (natoms, 3) (e.g., a normal mode from
+            ``molecule.vibdisps``) or many modes of shape (nmodes, natoms, 3).
+        steps : array-like
+            Step sizes along the mode, or a list of those (one per mode).
+
+        Examples
+        --------
+        Finite-difference displacements along the first normal mode can be
+        generated with ``molecule.scan(molecule.vibdisps[0], [-0.01, 0.01])``.
+
+        """
+        modes = np.asarray(modes, dtype=float)
+        if modes.ndim == 2:
+            modes = modes[np.newaxis]
+            steps = [steps]
+
+        grid = np.stack(np.meshgrid(*steps, indexing="ij"), axis=-1)
+        grid = grid.reshape(-1, len(modes))
+
+        geometry = np.asarray(self.atomcoords[-1], dtype=float)
+        return self._with_atomcoords(geometry + np.einsum("km,mni->kni", grid, modes))
+
     def to_openbabel(self):
         """Return a OBMol."""
         obmol = cclib.bridge.makeopenbabel(
@@ -101,6 +406,516 @@ class Atoms:
                 return obc.WriteString(self.to_openbabel()).strip()
 
 
+class TemplateImporter:
+    """
+    Import modules from within templates (the ``import`` template global).
+
+    Modules are resolved once per process and cached, so templates calling
+    ``import("numpy")`` on every render (or inside loops) pay the import cost
+    only once. The time spent importing each module is kept in
+    ``TemplateImporter.import_times`` and logged at debug level.
+
+    Parameters
+    ----------
+    allowed : iterable of str, optional
+        Names of modules templates are allowed to import. Submodules of
+        allowed modules are allowed as well. If None, any module can be
+        imported.
+
+    Examples
+    --------
+    >>> importer = TemplateImporter(allowed=["math"])
+    >>> importer("math").sqrt(4.0)
+    2.0
+    >>> importer("os")
+    Traceback (most recent call last):
+        ...
+    jinja2.exceptions.SecurityError: import of module 'os' is not allowed
+
+    """
+
+    modules = {}
+    import_times = {}
+
+    def __init__(self, allowed=None):
+        """See docstring for this class."""
+        self.allowed = None if allowed is None else frozenset(allowed)
+
+    def is_allowed(self, name):
+        """Tell whether templates may import module name."""
+        if self.allowed is None:
+            return True
+        parts = name.split(".")
+        return any(
+            ".".join(parts[:i]) in self.allowed for i in range(1, len(parts) + 1)
+        )
+
+    def __call__(self, name):
+        """Return module name, importing it only if not done before."""
+        if not self.is_allowed(name):
+            raise SecurityError("import of module {!r} is not allowed".format(name))
+
+        try:
+            return self.modules[name]
+        except KeyError:
+            start = time.perf_counter()
+            module = importlib.import_module(name)
+            self.import_times[name] = time.perf_counter() - start
+            logger.debug(
+                "template import of %s took %.6f s", name, self.import_times[name]
+            )
+
+            self.modules[name] = module
+            return module
+
+
+class ImportSandbox(SandboxedEnvironment):
+    """
+    A ``jinja2.sandbox.SandboxedEnvironment`` aware of template imports.
+
+    Allowed modules often expose other modules (and functions or classes
+    defined in them) as attributes, e.g. ``json.codecs``. Those are refused
+    unless they come from modules in the allow-list of ``importer``.
+
+    Parameters
+    ----------
+    importer : TemplateImporter
+        The object used as ``import`` in templates.
+
+    Extra named arguments are passed directly to
+    ``jinja2.sandbox.SandboxedEnvironment``.
+
+    """
+
+    def __init__(self, importer, **kwargs):
+        """See docstring for this class."""
+        super().__init__(**kwargs)
+        self.importer = importer
+        self.globals.update({"import": importer})
+
+    def is_safe_attribute(self, obj, attr, value):
+        """Refuse modules, functions and classes that are not allowed."""
+        if isinstance(value, types.ModuleType):
+            if not self.importer.is_allowed(value.__name__):
+                return False
+        elif isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type)):
+            module = getattr(value, "__module__", None)
+            if module is not None and not self.importer.is_allowed(module):
+                return False
+        return super().is_safe_attribute(obj, attr, value)
+
+
+DEFAULT_RMSD_THRESHOLD = 0.1
+
+
+def _aligned_rmsd(reference, others):
+    """
+    Return the RMSD between reference and each of others after optimal
+    superposition (Kabsch algorithm). All coordinates must be centered.
+    """
+    covariances = np.einsum("kni,nj->kij", others, reference)
+    u, singular_values, vt = np.linalg.svd(covariances)
+    singular_values[:, -1] *= np.sign(np.linalg.det(u) * np.linalg.det(vt))
+
+    squared_deviations = (
+        (others**2).sum(axis=(1, 2))
+        + (reference**2).sum()
+        - 2.0 * singular_values.sum(axis=1)
+    )
+    return np.sqrt(np.maximum(squared_deviations, 0.0) / len(reference))
+
+
+class _DuplicateCell:
+    """Unique structures sharing a key and a cell of the pre-filter grid."""
+
+    def __init__(self, natoms):
+        """See docstring for this class."""
+        self.size = 0
+        self._indices = np.empty(4, dtype=int)
+        self._norms = np.empty((4, natoms))
+        self._coords = np.empty((4, natoms, 3))
+
+    def add(self, index, norms, coords):
+        """Add a unique structure, growing buffers geometrically if needed."""
+        if self.size == len(self._indices):
+            capacity = 2 * self.size
+            self._indices = np.resize(self._indices, capacity)
+            self._norms = np.resize(self._norms, (capacity,) + self._norms.shape[1:])
+            self._coords = np.resize(self._coords, (capacity,) + self._coords.shape[1:])
+
+        self._indices[self.size] = index
+        self._norms[self.size] = norms
+        self._coords[self.size] = coords
+        self.size += 1
+
+    def arrays(self):
+        """Return views of indices, norms and coordinates of all structures."""
+        return (
+            self._indices[: self.size],
+            self._norms[: self.size],
+            self._coords[: self.size],
+        )
+
+
+class _DuplicateFinder:
+    """Incremental search for duplicates (see find_duplicates)."""
+
+    neighbours = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+
+    def __init__(self, threshold):
+        """See docstring for this class."""
+        if threshold <= 0:
+            raise ValueError("threshold must be positive, not {!r}".format(threshold))
+        self.threshold = threshold
+        self.cells = {}
+
+    def find(self, index, key, coords):
+        """
+        Return the smallest index of a structure duplicated by coords, or None.
+
+        Unique structures are remembered under index for later searches.
+        """
+        coords = np.asarray(coords, dtype=float)
+        coords = coords - coords.mean(axis=0)
+        norms = np.linalg.norm(coords, axis=1)
+
+        radii = np.zeros(3)
+        singular_values = np.linalg.svd(coords, compute_uv=False)
+        radii[: len(singular_values)] = singular_values / np.sqrt(len(coords))
+        cell = tuple(np.floor(radii / self.threshold).astype(int))
+        max_deviation = len(coords) * self.threshold**2
+
+        matches = []
+        for i, j, k in self.neighbours:
+            neighbour = self.cells.get((key, cell[0] + i, cell[1] + j, cell[2] + k))
+            if neighbour is None:
+                continue
+            indices, kept_norms, kept_coords = neighbour.arrays()
+
+            close = ((kept_norms - norms) ** 2).sum(axis=1) < max_deviation
+            if close.any():
+                rmsds = _aligned_rmsd(coords, kept_coords[close])
+                matches.extend(indices[close][rmsds < self.threshold])
+        if matches:
+            return int(min(matches))
+
+        self.cells.setdefault((key,) + cell, _DuplicateCell(len(coords))).add(
+            index, norms, coords
+        )
+        return None
+
+
+def find_duplicates(structures, threshold=DEFAULT_RMSD_THRESHOLD):
+    """
+    Find duplicate structures based on their aligned RMSD.
+
+    Structures are first grouped by a hashable key (e.g., atomic numbers,
+    charge and multiplicity), so only structures sharing the same key are
+    ever compared. Atoms are assumed to be in the same order within a group.
+
+    Two cheap lower bounds to the aligned RMSD are used as pre-filters
+    before superposition. Principal radii (the singular values of centered
+    coordinates, divided by the square root of the number of atoms) are
+    hashed into a grid with cells of size ``threshold``, so that only
+    structures in neighbouring cells are looked at. Those are then filtered
+    by the RMS difference between atomic distances to the centroid, and the
+    remaining candidates are superimposed in bulk.
+
+    Parameters
+    ----------
+    structures : iterable of (key, coords)
+        Hashable keys and coordinates of shape (natoms, 3).
+    threshold : float, optional
+        Structures with RMSD below this are considered duplicates.
+
+    Returns
+    -------
+    dict
+        Maps the index of each duplicate structure to the index of the first
+        structure it duplicates. Unique structures are absent.
+
+    Examples
+    --------
+    >>> water = [[0.0, 0.0, 0.1173], [0.0, 0.7572, -0.4692], [0.0, -0.7572, -0.4692]]
+    >>> rotated = [[0.1173, 0.0, 0.0], [-0.4692, 0.0, 0.7572], [-0.4692, 0.0, -0.7572]]
+    >>> find_duplicates([("H2O", water), ("H2O", rotated), ("OH2", water)])
+    {1: 0}
+
+    """
+    finder = _DuplicateFinder(threshold)
+
+    duplicates = {}
+    for index, (key, coords) in enumerate(structures):
+        original = finder.find(index, key, coords)
+        if original is not None:
+            duplicates[index] = original
+    return duplicates
+
+
+def deduplicate(molecules, threshold=DEFAULT_RMSD_THRESHOLD):
+    """
+    Remove duplicate molecules and frames (geometries) from a collection.
+
+    Frames are compared across all molecules as in ``find_duplicates``, using
+    atomic numbers, charge and multiplicity as keys. The last frame of each
+    molecule (the one used by ``to_string``) is compared first: if it
+    duplicates a previous structure, the whole molecule is skipped, so that
+    an earlier frame never takes its place. Otherwise, it is kept, and any
+    other frame duplicating a previous structure is removed.
+
+    Parameters
+    ----------
+    molecules : list of Atoms
+    threshold : float, optional
+        Frames with aligned RMSD below this are considered duplicates.
+
+    Returns
+    -------
+    unique : list of Atoms or None
+        Molecules with only unique frames, in the same order as given.
+        Skipped molecules are replaced by None.
+    skipped : list of tuple
+        Pairs of ``(molecule_index, frame_index)`` tuples, the first being
+        a skipped frame and the second the frame it duplicates. The first
+        ``frame_index`` is None when the whole molecule was skipped.
+
+    """
+    finder = _DuplicateFinder(threshold)
+    frames = []
+    skipped = []
+
+    unique = []
+    for i, molecule in enumerate(molecules):
+        key = (tuple(molecule.atomnos), molecule.charge, molecule.mult)
+        nframes = len(molecule.atomcoords)
+
+        kept = []
+        for frame in reversed(range(nframes)):
+            original = finder.find(len(frames), key, molecule.atomcoords[frame])
+            frames.append((i, frame))
+
+            if original is None:
+                kept.insert(0, frame)
+            elif frame == nframes - 1:
+                skipped.append(((i, None), frames[original]))
+                break
+            else:
+                skipped.append(((i, frame), frames[original]))
+
+        if not kept:
+            unique.append(None)
+        elif len(kept) < nframes:
+            unique.append(
+                molecule._with_atomcoords(np.asarray(molecule.atomcoords)[kept])
+            )
+        else:
+            unique.append(molecule)
+    return unique, sorted(skipped, key=lambda pair: (pair[0][0], pair[0][1] or 0))
+
+
+FSYNC_POLICIES = ["none", "file", "batch"]
+
+
+def _file_mode():
+    """
+    Return the permissions open() gives to new files, i.e., 0o666 minus umask.
+
+    The umask is read from /proc where available, since setting it (the
+    only portable way of reading it) is not thread-safe.
+    """
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith("Umask:"):
+                    return 0o666 & ~int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+_FILE_MODE = _file_mode()
+
+
+class OutputWriter:
+    """
+    Write generated inputs to disk atomically.
+
+    Each file is first written to a temporary file in the same directory,
+    which is then renamed over the target path, so that interrupted batches
+    never leave truncated inputs behind. Existing files keep their
+    permissions, and symbolic links are followed.
+
+    Parameters
+    ----------
+    fsync : {"none", "file", "batch"}, optional
+        When to flush written files to disk: never (leaving it to the
+        operating system), after each file, or once for all files written
+        so far when ``sync`` (or ``close``) is called. Files are always
+        flushed before being renamed, so with "batch", files only appear at
+        their paths after ``sync`` (or ``close``).
+    buffering : int, optional
+        Size in bytes of write buffers.
+    dry_run : bool, optional
+        If True, nothing is written to disk. Paths are still returned by
+        ``write``, and the amount of data that would have been written is
+        still counted.
+
+    Attributes
+    ----------
+    nfiles : int
+        Number of files written so far.
+    nbytes : int
+        Number of bytes (as encoded) written so far.
+
+    Examples
+    --------
+    >>> with OutputWriter(fsync="batch") as writer:
+    ...     writer.write("/tmp/hello.inp", "hello")
+    '/tmp/hello.inp'
+    >>> open("/tmp/hello.inp").read()
+    'hello'
+
+    """
+
+    def __init__(self, fsync="none", buffering=1 << 20, dry_run=False):
+        """See docstring for this class."""
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(
+                "fsync must be one of {}, not {!r}".format(FSYNC_POLICIES, fsync)
+            )
+        self.fsync = fsync
+        self.buffering = buffering
+        self.dry_run = dry_run
+
+        self.nfiles = 0
+        self.nbytes = 0
+        self._unsynced = []
+
+    def write(self, path, content):
+        """Atomically write content (a str) to path and return path."""
+        if self.dry_run:
+            self.nbytes += len(content.encode())
+            self.nfiles += 1
+            return path
+
+        # Symbolic links are written through, as open() would do
+        target = os.path.realpath(path)
+        directory = os.path.dirname(target)
+        fd, temporary_path = tempfile.mkstemp(
+            prefix=".{:s}.".format(os.path.basename(target)),
+            suffix=".tmp",
+            dir=directory,
+        )
+        try:
+            with open(fd, "w", buffering=self.buffering) as stream:
+                stream.write(content)
+                stream.flush()
+                self.nbytes += stream.buffer.tell()
+
+                if self.fsync == "file":
+                    os.fsync(stream.fileno())
+            _copy_file_mode(target, temporary_path)
+
+            if self.fsync == "batch":
+                self._unsynced.append((temporary_path, target))
+            else:
+                os.replace(temporary_path, target)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+        if self.fsync == "file":
+            _fsync_directory(directory)
+
+        self.nfiles += 1
+        return path
+
+    def sync(self):
+        """
+        Flush to disk all files written since the last call (batch fsync).
+
+        Temporary files are flushed before being renamed to their paths, and
+        directories are flushed after that.
+        """
+        unsynced, self._unsynced = self._unsynced, []
+        directories = set()
+        renamed = 0
+        try:
+            for temporary_path, _ in unsynced:
+                fd = os.open(temporary_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            for temporary_path, path in unsynced:
+                os.replace(temporary_path, path)
+                directories.add(os.path.dirname(path) or os.curdir)
+                renamed += 1
+        finally:
+            # Files not renamed (because of an error) are not left behind
+            for temporary_path, _ in unsynced[renamed:]:
+                os.remove(temporary_path)
+
+        for directory in directories:
+            _fsync_directory(directory)
+
+    def close(self):
+        """Finish the batch, flushing files to disk if needed."""
+        self.sync()
+
+    def __enter__(self):
+        """Use writer as a context manager, closing it at the end."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close writer."""
+        self.close()
+
+
+def _copy_file_mode(path, temporary_path):
+    """
+    Give temporary_path the permissions (and, if possible, the ownership) of
+    path, or those open() would give a new file if path does not exist.
+    """
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        os.chmod(temporary_path, _FILE_MODE)
+        return
+
+    try:
+        os.chown(temporary_path, status.st_uid, status.st_gid)
+    except OSError:
+        pass
+    os.chmod(temporary_path, status.st_mode & 0o7777)
+
+
+def _fsync_directory(directory):
+    """Flush renames in directory to disk, where supported."""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _positive_float(value):
+    """Convert a command-line argument to a positive float."""
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("must be positive: {!r}".format(value))
+    return number
+
+
 def argparser():
     """
     Return a parser for the command-line interface (pnictogen.main).
@@ -136,6 +951,42 @@ def argparser():
         action="store_true",
         help="create a simple boilerplate input template for you to modify",
     )
+    parser.add_argument(
+        "-l",
+        "--last-geometry",
+        action="store_true",
+        help="""read only the last geometry, charge and multiplicity of
+        ORCA and Gaussian outputs, seeking from the end of the file (other
+        files are fully parsed as usual)""",
+    )
+    parser.add_argument(
+        "-d",
+        "--deduplicate",
+        action="store_true",
+        help="""skip molecules and frames that duplicate a previous one with
+        the same atoms, charge and multiplicity (see --rmsd)""",
+    )
+    parser.add_argument(
+        "--rmsd",
+        type=_positive_float,
+        default=DEFAULT_RMSD_THRESHOLD,
+        help="""largest aligned RMSD (in angstroms) between duplicates
+        (default: %(default)s)""",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="render templates but do not write any files",
+    )
+    parser.add_argument(
+        "--fsync",
+        choices=FSYNC_POLICIES,
+        default="none",
+        help="""when to flush written inputs to disk: never, after each file,
+        or once after all files, in which case inputs only appear (and are
+        reported) at the end (default: %(default)s)""",
+    )
     parser.add_argument(
         "-v", "--version", action="version", version="%(prog)s {:s}".format(__version__)
     )
@@ -162,6 +1013,28 @@ def argparser():
     return parser
 
 
+def _read_descriptor(descriptor, last_geometry=False):
+    """Read a descriptor file into an Atoms object (see main)."""
+    description_extension = os.path.splitext(descriptor)[1]
+
+    data = None
+    if last_geometry:
+        data = read_last_geometry(descriptor)
+
+    try:
+        if data is None:
+            data = cclib.ccopen(descriptor).parse()
+        molecule = Atoms(data)
+    except KeyError:
+        molecule = Atoms(
+            cclib.bridge.cclib2openbabel.readfile(descriptor, description_extension[1:])
+        )
+
+    if not molecule.name:
+        molecule.name = descriptor
+    return molecule
+
+
 def main(argv=sys.argv[1:]):
     """
     Pnictogen command-line interface. It writes inputs for sets of molecules.
@@ -198,28 +1071,56 @@ def main(argv=sys.argv[1:]):
             stream.write(content)
         print("{:s} written".format(args.template))
     else:
-        for descriptor in args.descriptors:
-            input_prefix, description_extension = os.path.splitext(descriptor)
-
-            try:
-                molecule = Atoms(cclib.ccopen(descriptor).parse())
-            except KeyError:
-                molecule = Atoms(
-                    cclib.bridge.cclib2openbabel.readfile(
-                        descriptor, description_extension[1:]
+        # Descriptors are read lazily, so that each input is written as soon
+        # as its descriptor is read, unless all are needed for deduplication
+        molecules = (
+            _read_descriptor(descriptor, args.last_geometry)
+            for descriptor in args.descriptors
+        )
+
+        if args.deduplicate:
+            molecules = list(molecules)
+            nframes = [len(molecule.atomcoords) for molecule in molecules]
+
+            def label(i, frame):
+                if nframes[i] > 1 and frame is not None:
+                    return "{:s} frame {:d}".format(args.descriptors[i], frame + 1)
+                return args.descriptors[i]
+
+            molecules, skipped = deduplicate(molecules, args.rmsd)
+            for duplicate, original in skipped:
+                print(
+                    "{:s} skipped (duplicate of {:s})".format(
+                        label(*duplicate), label(*original)
                     )
                 )
 
-            if not molecule.name:
-                molecule.name = descriptor
+        message = "{:s} would be written" if args.dry_run else "{:s} written"
 
-            written_files = pnictogen(molecule, input_prefix, args.template, extension)
+        # With batch fsync, files only appear at their paths once the writer
+        # is closed, so they are reported after that
+        pending_files = []
+        with OutputWriter(fsync=args.fsync, dry_run=args.dry_run) as writer:
+            for descriptor, molecule in zip(args.descriptors, molecules):
+                if molecule is None:
+                    continue
+                input_prefix = os.path.splitext(descriptor)[0]
 
-            for written_file in written_files:
-                print("{:s} written".format(written_file))
+                written_files = pnictogen(
+                    molecule, input_prefix, args.template, extension, writer
+                )
+
+                if args.fsync == "batch":
+                    pending_files.extend(written_files)
+                    continue
+                for written_file in written_files:
+                    print(message.format(written_file))
+
+        for written_file in pending_files:
+            print(message.format(written_file))
 
 
-def pnictogen(molecule, input_prefix, template, extension=None, **kwargs):
+def pnictogen(molecule, input_prefix, template, extension=None, writer=None, **kwargs):
     """
     Generate inputs based on a template and a collection of molecules.
 
@@ -235,8 +1136,15 @@ def pnictogen(molecule, input_prefix, template, extension=None, **kwargs):
     extension : str, optional
         File extension common to all generated input files. If not set, the
         template path will be used to select one.
+    writer : OutputWriter, optional
+        Object used to write files. If not set, files are written atomically
+        with default settings.
     extensions : list, optional
         A set of extensions that are directly passed to Jinja2
+    sandboxed : bool, optional
+        Render the template in a ``jinja2.sandbox.SandboxedEnvironment``
+    allowed_modules : list of str, optional
+        Modules the template is allowed to import (see ``TemplateImporter``)
 
     Extra named arguments are passed directly to the template
 
@@ -258,6 +1166,9 @@ def pnictogen(molecule, input_prefix, template, extension=None, **kwargs):
     if extension is None:
         package, extension = os.path.basename(template).split(".")[-2:]
 
+    if writer is None:
+        writer = OutputWriter()
+
     written_files = []
 
     raw_rendered = render_template(
@@ -275,10 +1186,7 @@ def pnictogen(molecule, input_prefix, template, extension=None, **kwargs):
 
         if rendered.strip():
             path = "{:s}{:s}.{:s}".format(input_prefix, at_id, extension)
-            with open(path, "w") as stream:
-                stream.write(rendered)
-
-            written_files.append(path)
+            written_files.append(writer.write(path, rendered))
     return written_files
 
 
@@ -292,6 +1200,12 @@ def render_template(template, **kwargs):
         Path to Jinja2 template file, relative to the local directory
     extensions : list, optional
         A set of extensions that are directly passed to Jinja2
+    sandboxed : bool, optional
+        Render the template in a sandbox (see ``ImportSandbox``). In this
+        case, templates can only use modules in ``allowed_modules``.
+    allowed_modules : list of str, optional
+        Modules the template is allowed to import. If not set, any module can
+        be imported, unless ``sandboxed`` is True, in which case none can.
 
     Extra named arguments are passed directly to the template
 
@@ -326,11 +1240,20 @@ def render_template(template, **kwargs):
 
     """
     extensions = kwargs.pop("extensions", [])
+    sandboxed = kwargs.pop("sandboxed", False)
+    allowed_modules = kwargs.pop("allowed_modules", None)
+    if sandboxed and allowed_modules is None:
+        allowed_modules = []
 
-    jinja_env = Environment(
+    importer = TemplateImporter(allowed_modules)
+    options = dict(
         loader=FileSystemLoader("./"), extensions=extensions, trim_blocks=True
     )
-    jinja_env.globals.update({"import": importlib.import_module})
+    if sandboxed:
+        jinja_env = ImportSandbox(importer, **options)
+    else:
+        jinja_env = Environment(**options)
+        jinja_env.globals.update({"import": importer})
 
     try:
         template_jinja = jinja_env.get_template(template)
@@ -4,12 +4,26 @@
 """Tests for pnictogen module."""
 
 import os
+import shutil
 from glob import iglob
 from contextlib import contextmanager
 
 import cclib
-from nose.tools import assert_equals
-from pnictogen import Atoms, argparser, main, pnictogen
+import numpy as np
+from jinja2.exceptions import SecurityError
+from nose.tools import assert_equals, assert_raises
+from pnictogen import (
+    Atoms,
+    OutputWriter,
+    TemplateImporter,
+    argparser,
+    deduplicate,
+    find_duplicates,
+    main,
+    pnictogen,
+    read_last_geometry,
+    render_template,
+)
 
 # Only testing xyz files because I trust Open Babel to handle other file types
 example_xyz_files = iglob("data/*.xyz")
@@ -367,3 +381,220 @@ H         -1.2987600000        2.7746520000        1.0975680000
 
 """,
     )
+
+
+def test_read_last_geometry():
+    """Test if the last geometry is correctly read from the end of outputs."""
+    data = cclib.ccopen("data/benzene.out").parse()
+    for chunk_size in [64, 1000, 1 << 20]:
+        tail_data = read_last_geometry("data/benzene.out", chunk_size)
+
+        assert_equals(tail_data.atomcoords.shape, (1, 12, 3))
+        assert_equals(tail_data.atomcoords[-1].tolist(), data.atomcoords[-1].tolist())
+        assert_equals(tail_data.atomnos.tolist(), data.atomnos.tolist())
+        assert_equals(tail_data.charge, data.charge)
+        assert_equals(tail_data.mult, data.mult)
+
+    assert_equals(read_last_geometry("data/water.xyz"), None)
+
+    # Unparseable coordinate blocks give up without reading the whole file
+    with open("/tmp/broken.out", "w") as stream:
+        stream.write(open("data/benzene.out").read().replace("  H    ", "  Xx   "))
+    assert_equals(read_last_geometry("/tmp/broken.out"), None)
+
+    shutil.copy("data/benzene.out", "/tmp/benzene.out")
+    main(["-g", "/tmp/fnord.Gaussian.gjf"])
+    main(["/tmp/fnord.Gaussian.gjf", "/tmp/benzene.out"])
+    full_parse = open("/tmp/benzene.gjf").read()
+    main(["-l", "/tmp/fnord.Gaussian.gjf", "/tmp/benzene.out"])
+    assert_equals(open("/tmp/benzene.gjf").read(), full_parse)
+
+
+def test_template_import():
+    """Test if templates can import modules, possibly sandboxed."""
+    with open("/tmp/import.inp", "w") as stream:
+        stream.write('{{ import("math").sqrt(x) }}')
+
+    assert_equals(render_template("/tmp/import.inp", x=4.0), "2.0")
+    assert_equals(
+        render_template(
+            "/tmp/import.inp", x=9.0, sandboxed=True, allowed_modules=["math"]
+        ),
+        "3.0",
+    )
+    assert_equals(TemplateImporter()("math"), TemplateImporter.modules["math"])
+    assert "math" in TemplateImporter.import_times
+
+    with assert_raises(SecurityError):
+        render_template("/tmp/import.inp", x=4.0, sandboxed=True)
+    with assert_raises(SecurityError):
+        render_template("/tmp/import.inp", x=4.0, sandboxed=True, allowed_modules=None)
+    with assert_raises(SecurityError):
+        render_template("/tmp/import.inp", x=4.0, allowed_modules=["os"])
+
+    # Modules exposed by allowed modules are not reachable in the sandbox
+    with open("/tmp/escape.inp", "w") as stream:
+        stream.write('{{ import("json").codecs.open("/etc/hostname").read() }}')
+    with assert_raises(SecurityError):
+        render_template("/tmp/escape.inp", sandboxed=True, allowed_modules=["json"])
+    with open("/tmp/escape.inp", "w") as stream:
+        stream.write('{{ import("json").dumps([1]) }}')
+    assert_equals(
+        render_template("/tmp/escape.inp", sandboxed=True, allowed_modules=["json"]),
+        "[1]",
+    )
+
+    importer = TemplateImporter(allowed=["os"])
+    assert importer.is_allowed("os.path")
+    assert not importer.is_allowed("ossaudiodev")
+
+
+def test_geometry_transformations():
+    """Test if bulk geometry transformations work."""
+    mol = Atoms(cclib.bridge.cclib2openbabel.readfile("data/water.xyz", "xyz"))
+    mol.name = "data/water.xyz"
+    natoms = len(mol.atomnos)
+
+    centered = mol.centered()
+    assert np.allclose(centered.atomcoords[-1].mean(axis=0), 0.0)
+    assert_equals(centered.name, mol.name)
+
+    aligned = mol.aligned()
+    second_moments = aligned.atomcoords[-1].T @ aligned.atomcoords[-1]
+    assert np.allclose(second_moments, np.diag(np.diag(second_moments)))
+    assert np.all(np.diff(np.diag(second_moments)) <= 0.0)
+
+    displaced = mol.displaced([1.0, 0.0, 0.0])
+    assert np.allclose(
+        displaced.atomcoords[-1] - np.asarray(mol.atomcoords[-1]), [1.0, 0.0, 0.0]
+    )
+
+    mode = np.ones((natoms, 3))
+    scan = mol.scan(mode, [-0.1, 0.0, 0.1])
+    assert_equals(np.shape(scan.atomcoords), (3, natoms, 3))
+    assert np.allclose(scan.atomcoords[1], mol.atomcoords[-1])
+
+    grid = mol.scan([mode, -mode], [[-0.1, 0.1], [0.0, 0.1, 0.2]])
+    assert_equals(np.shape(grid.atomcoords), (6, natoms, 3))
+
+    frames = scan.frames()
+    assert_equals(len(frames), 3)
+    assert_equals(frames[1].to_string("xyz"), mol.to_string("xyz"))
+
+    # Other parsed data is kept in transformed copies
+    benzene = Atoms(cclib.ccopen("data/benzene.out").parse())
+    centered = benzene.centered()
+    assert_equals(centered.atommasses.tolist(), benzene.atommasses.tolist())
+    assert_equals(np.shape(centered.atomcoords), np.shape(benzene.atomcoords))
+    assert_equals(centered.frames()[-1].vibdisps.shape, benzene.vibdisps.shape)
+    centered.aligned(centered.atommasses)
+
+
+def test_deduplicate():
+    """Test if duplicate structures are correctly found."""
+    water = Atoms(cclib.bridge.cclib2openbabel.readfile("data/water.xyz", "xyz"))
+    co = Atoms(cclib.bridge.cclib2openbabel.readfile("data/co.xyz", "xyz"))
+
+    moved = water.aligned().displaced([1.0, 2.0, 3.0])
+    mode = np.zeros((3, 3))
+    mode[1, 0] = 1.0
+    scan = water.scan(mode, [0.0, 0.5, 0.05])
+    distorted = water.scan(np.eye(3), [0.5])
+
+    molecules, skipped = deduplicate([water, co, moved, scan, distorted])
+    assert_equals(molecules[:2], [water, co])
+    assert_equals(molecules[2], None)
+    assert_equals(molecules[3], None)
+    assert_equals(molecules[4], distorted)
+    assert_equals(skipped, [((2, None), (0, 0)), ((3, None), (0, 0))])
+
+    molecules, skipped = deduplicate([scan, water])
+    assert np.allclose(molecules[0].atomcoords, scan.atomcoords[1:])
+    assert_equals(molecules[1], None)
+    assert_equals(skipped, [((0, 0), (0, 2)), ((1, None), (0, 2))])
+
+    # Molecules whose last (rendered) frame is a duplicate are skipped, even
+    # if earlier frames are unique
+    optimization = Atoms(cclib.ccopen("data/benzene.out").parse())
+    molecules, skipped = deduplicate(
+        [optimization.frames()[-1], optimization], threshold=0.01
+    )
+    assert_equals(molecules[1], None)
+    assert_equals(skipped, [((1, None), (0, 0))])
+
+    coords = water.atomcoords[-1]
+    assert_equals(find_duplicates([]), {})
+    with assert_raises(ValueError):
+        find_duplicates([("a", coords)], threshold=0.0)
+    with assert_raises(SystemExit):
+        argparser().parse_args(["--rmsd", "0", "pnictogen/repo/ORCA.inp"])
+    assert_equals(find_duplicates([("a", coords), ("b", coords)]), {})
+    assert_equals(
+        find_duplicates([("a", coords), ("a", coords), ("a", coords)]), {1: 0, 2: 0}
+    )
+
+
+def test_output_writer():
+    """Test if inputs are correctly written (or not written at all)."""
+    path = "/tmp/pnictogen-writer.inp"
+    if os.path.exists(path):
+        os.remove(path)
+
+    with OutputWriter(dry_run=True) as writer:
+        assert_equals(writer.write(path, "foo\n"), path)
+    assert not os.path.exists(path)
+    assert_equals((writer.nfiles, writer.nbytes), (1, 4))
+
+    for fsync in ["none", "file", "batch"]:
+        with OutputWriter(fsync=fsync) as writer:
+            writer.write(path, "bar {}\n".format(fsync))
+        assert_equals(open(path).read(), "bar {}\n".format(fsync))
+        assert_equals(writer.nfiles, 1)
+
+    # With batch fsync, files are flushed before being renamed at the end
+    os.remove(path)
+    with OutputWriter(fsync="batch") as writer:
+        writer.write(path, "batch\n")
+        assert not os.path.exists(path)
+        assert_equals(len(list(iglob("/tmp/.pnictogen-writer.inp.*"))), 1)
+    assert_equals(open(path).read(), "batch\n")
+    assert_equals(list(iglob("/tmp/.pnictogen-writer.inp.*")), [])
+    with OutputWriter(fsync="batch") as writer:
+        writer.write(path, "bar batch\n")
+
+    # Interrupted writes keep previous contents and leave nothing behind
+    with assert_raises(TypeError):
+        OutputWriter().write(path, None)
+    assert_equals(open(path).read(), "bar batch\n")
+    assert_equals(list(iglob("/tmp/.pnictogen-writer.inp.*")), [])
+
+    with assert_raises(ValueError):
+        OutputWriter(fsync="always")
+
+    # Existing files keep their permissions
+    os.chmod(path, 0o640)
+    for fsync in ["none", "batch"]:
+        with OutputWriter(fsync=fsync) as writer:
+            writer.write(path, "mode\n")
+        assert_equals(os.stat(path).st_mode & 0o777, 0o640)
+
+    # Symbolic links are written through
+    link = "/tmp/pnictogen-writer-link.inp"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(path, link)
+    for fsync in ["none", "batch"]:
+        with OutputWriter(fsync=fsync) as writer:
+            assert_equals(writer.write(link, fsync), link)
+        assert os.path.islink(link)
+        assert_equals(open(path).read(), fsync)
+
+    mol = Atoms(cclib.bridge.cclib2openbabel.readfile("data/co.xyz", "xyz"))
+    writer = OutputWriter(dry_run=True)
+    assert_equals(
+        pnictogen(
+            mol, "/tmp/pnictogen-dry-run", "pnictogen/repo/ORCA.inp", writer=writer
+        ),
+        ["/tmp/pnictogen-dry-run.inp"],
+    )
+    assert not os.path.exists("/tmp/pnictogen-dry-run.inp")